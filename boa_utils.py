@@ -19,20 +19,37 @@ user:
 # built-in module imports
 from multiprocessing import Value
 import os
+import shutil
 from io import BytesIO
 import warnings
 import re
 import logging
 import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # external dependencies
 import yaml
+# credentials must be read verbatim, so use the BaseLoader family, which
+# keeps every scalar a string - the libyaml C binding when available
+try:
+    from yaml import CBaseLoader as yaml_loader
+except ImportError:
+    from yaml import BaseLoader as yaml_loader
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from astropy.io.votable import parse_single_table
 from astropy.io.votable.exceptions import VOTableSpecWarning
+from astropy.table import Table
 import pandas as pd
 
+# lxml parses the (large) /tables meta-data XML much faster than the
+# standard library - fall back to ElementTree when it is not installed
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
 # Set up logging
 log = logging.getLogger(__name__)
 warnings.simplefilter('ignore', category=VOTableSpecWarning)
@@ -50,6 +67,17 @@ default_config = os.path.join(
 # expected timestamp format: 2019-04-27 07:49:11.688
 date_format = '%Y-%m-%d %H:%M:%S.%f'
 
+# cache of parsed config files, keyed by absolute path. Each entry stores
+# the file's (st_mtime_ns, st_size) so a changed file is re-read
+_config_cache = {}
+
+# pre-compiled pattern for filenames in content-disposition headers
+filename_re = re.compile(r'filename=(.+)')
+
+# timestamp columns in the TELEMETRY_PACKET table
+time_columns = frozenset({'on_board_time', 'ground_station_reception_time',
+    'ingested_time', 'bscs_ingestion_time', 'proprietary_end_date'})
+
 def exception(function):
     """
     A decorator that wraps the passed in function and handles
@@ -77,8 +105,19 @@ class BOA:
         self.url = url
         self.dl_url = dl_url
         self.config = None
+        self._tables_cache = None
+        self._subsystems_cache = None
         self.load_config(config_file)
 
+        # a persistent session keeps the TCP/TLS connection alive between
+        # requests and sends the basic-auth credentials automatically
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        if self.config is not None:
+            self._session.auth = HTTPBasicAuth(
+                self.config['user']['login'], self.config['user']['password'])
+
 
     def _url(self, path, dl=False):
         """Helper function to append the path to the base URL"""
@@ -91,13 +130,26 @@ class BOA:
 
     def load_config(self, config_file):
         """Load the configuration file containing, at minimum,
-        the username and password for BOA authentication"""
+        the username and password for BOA authentication. Parsed
+        files are cached and only re-read when they change on disk"""
+
+        config_file = os.path.abspath(config_file)
 
         try:
-            f = open(config_file, 'r')
-            self.config = yaml.load(f, Loader=yaml.BaseLoader)
+            stat = os.stat(config_file)
         except FileNotFoundError:
             log.error('config file {:s} not found'.format(config_file))
+            return
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = _config_cache.get(config_file)
+        if cached is not None and cached[0] == stamp:
+            self.config = cached[1]
+            return
+
+        with open(config_file, 'r') as f:
+            self.config = yaml.load(f, Loader=yaml_loader)
+        _config_cache[config_file] = (stamp, self.config)
 
         return
 
@@ -120,8 +172,7 @@ class BOA:
 
         if 'telemetry_packet' not in query.lower():
             query = requests.utils.quote(query)
-            r = requests.get(url=self._url('/retrieve-data?'+query, dl=True), 
-                    auth=HTTPBasicAuth(self.config['user']['login'], self.config['user']['password']))
+            r = self._session.get(url=self._url('/retrieve-data?'+query, dl=True), stream=True)
             r.raise_for_status()
         else:
             default_payload = {
@@ -129,8 +180,7 @@ class BOA:
             query = {'QUERY': query}
             params = default_payload.copy()
             params.update(query)
-            r = requests.get(url=self._url('/retrieve-data', dl=True), params=params, 
-                auth=HTTPBasicAuth(self.config['user']['login'], self.config['user']['password']))
+            r = self._session.get(url=self._url('/retrieve-data', dl=True), params=params, stream=True)
             r.raise_for_status()
 
         if not r.status_code // 100 == 2:
@@ -142,18 +192,22 @@ class BOA:
             log.error('error retrieving filename from server response')
             return None
         dl_file = os.path.join(dl_path, filename)
-        f = open(dl_file, 'wb')
-        for chunk in r.iter_content(100000):
-            f.write(chunk)
-        f.close()
+        # copy straight from the raw stream to disk in 1 MiB blocks
+        r.raw.decode_content = True
+        with open(dl_file, 'wb') as f:
+            shutil.copyfileobj(r.raw, f, length=1<<20)
         
         log.info('retrieved file {:s}'.format(filename))
 
         if extract:
             import tarfile
-            tar = tarfile.open(dl_file)
-            tar.extractall(path=dl_path)
-            filename = tar.getnames()
+            # stream the archive in one sequential pass, collecting member
+            # names while extracting instead of re-walking it with getnames()
+            filename = []
+            with tarfile.open(dl_file, mode='r|*') as tar:
+                for member in tar:
+                    tar.extract(member, path=dl_path)
+                    filename.append(member.name)
             filename = [os.path.join(dl_path, f) for f in filename]
             log.info('extracted file(s): {:s}'.format(', '.join(filename)))
             if len(filename)==1:
@@ -162,55 +216,117 @@ class BOA:
         return filename
 
 
+    def query_many(self, queries, maxrows=5000, max_workers=8, format='votable'):
+        """
+        Runs several TAP queries concurrently with a thread pool, re-using
+        the shared session, and returns the results in the same order as
+        the input queries. The bottleneck is the server and the network,
+        so threads give cheap concurrency here
+        """
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda q: self.query(q, maxrows=maxrows, format=format), queries))
+
+        return results
+
+
+    def _subsystems(self):
+        """Returns the set of valid subsystem IDs. The list changes at
+        most once per mission phase, so the result is cached on the
+        instance - reset _subsystems_cache to None to force a refresh"""
+
+        if self._subsystems_cache is None:
+            self._subsystems_cache = frozenset(
+                self.query('select distinct subsystem_id from subsystem').subsystem_id.tolist())
+
+        return self._subsystems_cache
+
+
     @exception
-    def query(self, query, maxrows=5000):
+    def query(self, query, maxrows=5000, columns=None, format='votable'):
         """
         Makes a simple TAP query to the BOA server and converts the response
         to a pandas DataFrame. By default this makes a synchronous query and
-        the number of results can be changed by setting maxrows (default 5k)
+        the number of results can be changed by setting maxrows (default 5k).
+        If columns is given, only the listed columns are read from the
+        VOTable response, which reduces memory use for wide tables. The
+        server response format can be selected with format ('votable',
+        'fits' or 'csv') - FITS and CSV are typically much faster to parse
+        than VOTable for large results
         """
 
+        if format not in ('votable', 'fits', 'csv'):
+            log.error('format should be one of: votable, fits, csv')
+            return None
+
         default_payload = {
             'LANG': 'ADQL',
             'REQUEST': 'doQuery',
             'MAXREC': '{:d}'.format(maxrows)}
+        if format != 'votable':
+            default_payload['FORMAT'] = format
         query = {'QUERY': query}
 
         log.debug('Query: {:s}'.format(query['QUERY']))
         params = default_payload.copy()
         params.update(query)
-        r = requests.get(url=self._url('/sync'), params=params, 
-            auth=HTTPBasicAuth(self.config['user']['login'], self.config['user']['password']))
-        r.raise_for_status()
+        with self._session.get(url=self._url('/sync'), params=params, stream=True) as r:
+            r.raise_for_status()
 
-        if not r.status_code // 100 == 2:
-            log.error(r)
-            return None
+            if not r.status_code // 100 == 2:
+                log.error(r)
+                return None
 
-        # convert from a votable to an astropy table with to_table()
-        table = parse_single_table(BytesIO(r.content), pedantic=False).to_table()
-        cols = table.colnames
+            r.raw.decode_content = True
+
+            if format == 'csv':
+                # pandas' C engine reads the stream directly
+                result = pd.read_csv(r.raw, engine='c')
+            elif format == 'fits':
+                # FITS parsing needs a seekable file, so buffer the body
+                result = Table.read(BytesIO(r.content), format='fits').to_pandas()
+            else:
+                # parse the VOTable directly from the response stream and use
+                # its underlying structured array - the astropy Table
+                # intermediate copies the whole dataset only for it to be
+                # discarded again on DataFrame conversion. The read callable
+                # is passed rather than r.raw itself, since astropy tries to
+                # seek() file-like sources and the response stream cannot
+                array = parse_single_table(r.raw.read, verify='ignore', columns=columns).array
+                data = {}
+                for name in array.dtype.names:
+                    col = array[name]
+                    if col.ndim > 1:
+                        # BOA columns often arrive with shape (n, 1)
+                        col = col.reshape(len(array))
+                    data[name] = col
+                result = pd.DataFrame(data, copy=False)
 
         # If a single value is returned, simply return this, not a df
-        if len(table)==1 and len(table.columns)==1:
-            result = table[0][0].data[0]
-        else:
-            # convert to a pandas DataFrame. cannot use .to_pandas() directly
-            # since the columns have shape (1,) and pandas cannot handle
-            # "multidimensional" columns.
-            result = pd.DataFrame([], columns=cols)
-            for col in cols:
-                result[col] = table[col].flatten()
+        if len(result) == 1 and len(result.columns) == 1:
+            result = result.iloc[0, 0]
 
         return result
 
 
     @exception
-    def get_tables(self):
-        """Lists the available tables for making meta-data queries"""
-
-        r = requests.get(url=self._url('/tables'),
-            auth=HTTPBasicAuth(self.config['user']['login'], self.config['user']['password']))
+    def _tables_xml(self):
+        """Fetches and parses the /tables meta-data XML, caching the
+        parsed tree on the instance. When the server supplies an ETag a
+        conditional GET is used to revalidate, otherwise the cached tree
+        is simply re-used"""
+
+        if self._tables_cache is not None:
+            etag, root = self._tables_cache
+            if etag is None:
+                return root
+            r = self._session.get(url=self._url('/tables'),
+                headers={'If-None-Match': etag})
+            if r.status_code == 304:
+                return root
+        else:
+            r = self._session.get(url=self._url('/tables'))
         r.raise_for_status()
 
         if not r.status_code // 100 == 2:
@@ -218,8 +334,19 @@ class BOA:
             return None
 
         # this table is NOT a VOTable but some other VO format, so parsing manually
-        import xml.etree.ElementTree as ET
         root = ET.fromstring(r.content)
+        self._tables_cache = (r.headers.get('ETag'), root)
+
+        return root
+
+
+    @exception
+    def get_tables(self):
+        """Lists the available tables for making meta-data queries"""
+
+        root = self._tables_xml()
+        if root is None:
+            return None
 
         table_list = []
 
@@ -239,41 +366,47 @@ class BOA:
     def get_columns(self, schema, table):
         """Lists column meta-data for the given schema/table"""
 
-
-        r = requests.get(url=self._url('/tables'),
-            auth=HTTPBasicAuth(self.config['user']['login'], self.config['user']['password']))
-        r.raise_for_status()
-
-        if not r.status_code // 100 == 2:
-            log.error(r)
+        root = self._tables_xml()
+        if root is None:
             return None
 
-        # this table is NOT a VOTable but some other VO format, so parsing manually
-        import xml.etree.ElementTree as ET
-        root = ET.fromstring(r.content)
-
-        sch = root.find("./schema/[name='{:s}']".format(schema))
+        sch = root.find("./schema[name='{:s}']".format(schema))
         if sch is None:
             log.error('could not find schema')
             raise ValueError
             return None
 
-        tbl = sch.find(".//table/[name='{:s}']".format(table))
+        tbl = sch.find(".//table[name='{:s}']".format(table))
         if tbl is None:
             log.error('could not find table')
             raise ValueError
             return None
 
         cols = ['name', 'dataType']
-        cols_df = pd.DataFrame(columns=cols)
-        for i in tbl.findall('column'):
-            cols_df = cols_df.append(
-                pd.Series([i.find('name').text, i.find('dataType').text], 
-                index=cols), ignore_index=True)
+        rows = [{'name': i.find('name').text, 'dataType': i.find('dataType').text}
+            for i in tbl.findall('column')]
+        cols_df = pd.DataFrame(rows, columns=cols)
 
         return cols_df
 
 
+    def _table_columns(self, table):
+        """Returns the column names of the given table from the cached
+        /tables meta-data, or None if the table cannot be found"""
+
+        root = self._tables_xml()
+        if root is None:
+            return None
+
+        target = table.lower()
+        for tbl in root.iter('table'):
+            name = tbl.find('name')
+            if name is not None and name.text.lower().split('.')[-1] == target:
+                return [c.find('name').text for c in tbl.findall('column')]
+
+        return None
+
+
     def query_packets(self, start_time=None, stop_time=None, subsys=None, 
         spid=None, apid=None, pkt_type=None, pkt_subtype=None, maxrows=5000,
         reduced=True):
@@ -283,51 +416,70 @@ class BOA:
         """
 
         if subsys is not None:
-            subsystems = self.query('select distinct subsystem_id from subsystem').subsystem_id.tolist()
+            subsystems = self._subsystems()
             if subsys not in subsystems:
-                log.error('subsystem {:s} is not valid. Should be one of: {:s}'.format(str(subsys), ', '.join(subsystems)))
+                log.error('subsystem {:s} is not valid. Should be one of: {:s}'.format(str(subsys), ', '.join(sorted(subsystems))))
                 return None
 
         if start_time is None:
             start_time = pd.Timestamp.now() - pd.Timedelta(days=1)
-        elif type(start_time) == str:
+        elif isinstance(start_time, str):
             start_time = pd.Timestamp(start_time)
 
         if stop_time is None:
             stop_time = pd.Timestamp.now()
-        elif type(stop_time) == str:
+        elif isinstance(stop_time, str):
             stop_time = pd.Timestamp(stop_time)
 
-        query = "SELECT * FROM TELEMETRY_PACKET WHERE on_board_time >= '{:s}' and on_board_time <= '{:s}'".format(
-                start_time.strftime(date_format), stop_time.strftime(date_format), subsys)
+        start_s = start_time.strftime(date_format)
+        stop_s = stop_time.strftime(date_format)
+
+        drop_list = ['item_id', 'ground_station_id', 'mib_version', 'inactive',
+            'ingested_time', 'bscs_ingestion_time', 'proprietary_end_date', 'retrieval_url',
+            'telemetry_packet_oid']
+
+        # when reduced, project the columns at the ADQL level so the dropped
+        # columns are never transferred or parsed. Fall back to SELECT * and
+        # a client-side drop if the table meta-data is unavailable
+        select_cols = '*'
+        if reduced:
+            all_cols = self._table_columns('TELEMETRY_PACKET')
+            if all_cols is not None:
+                select_cols = ', '.join([c for c in all_cols if c.lower() not in drop_list])
+
+        # collect the WHERE clauses in a list and join once, rather than
+        # concatenating onto an immutable string per filter
+        clauses = [
+            "on_board_time >= '{:s}'".format(start_s),
+            "on_board_time <= '{:s}'".format(stop_s)]
 
         if subsys is not None:
-            query += " and subsystem_id='{:s}'".format(subsys)
+            clauses.append("subsystem_id='{:s}'".format(subsys))
 
         if pkt_type is not None:
-            query += ' and source_packet_service_type={:d}'.format(pkt_type)
+            clauses.append('source_packet_service_type={:d}'.format(pkt_type))
 
         if pkt_subtype is not None:
-            query += ' and source_packet_service_subtype={:d}'.format(pkt_subtype)
+            clauses.append('source_packet_service_subtype={:d}'.format(pkt_subtype))
 
         if spid is not None:
-            query += ' and telemetry_packet_spid={:d}'.format(spid)
+            clauses.append('telemetry_packet_spid={:d}'.format(spid))
+
+        query = 'SELECT {:s} FROM TELEMETRY_PACKET WHERE '.format(select_cols) + ' and '.join(clauses)
 
         log.debug(query)
         packets = self.query(query=query, maxrows=maxrows)
         if packets is None:
             return None
 
-        drop_list = ['item_id', 'ground_station_id', 'mib_version', 'inactive',
-            'ingested_time', 'bscs_ingestion_time', 'proprietary_end_date', 'retrieval_url',
-            'telemetry_packet_oid']
-
-        if reduced:
+        if reduced and select_cols == '*':
             packets.drop(drop_list, axis=1, inplace=True)
 
-        time_cols = [col for col in packets.columns if 'time' in col.lower()]
-        for col in time_cols:
-            packets[col] = pd.to_datetime(packets[col])
+        # ISO8601 keeps pandas on the vectorised parsing path while still
+        # accepting timestamps without a fractional-second part
+        time_cols = sorted(time_columns & set(packets.columns))
+        packets[time_cols] = packets[time_cols].apply(
+            pd.to_datetime, format='ISO8601', utc=True, cache=True)
 
         log.info('{:d} matching telemetry packets found'.format(len(packets)))
 
@@ -349,8 +501,7 @@ def get_events(instr=None, start_time=None, stop_time=None, get_descrip=False):
             get_descrip=False
 
     boa = BOA() 
-    subsys = boa.query('select distinct subsystem_id from subsystem')
-    if instr not in subsys.subsystem_id.tolist():
+    if instr not in boa._subsystems():
         log.error('subsystem {:s} is not valid'.format(str(instr)))
         return None
     
@@ -366,23 +517,25 @@ def get_events(instr=None, start_time=None, stop_time=None, get_descrip=False):
 def retrieve_packets(subsys=None, start_time=None, stop_time=None, dl_path='.', binary=True, extract=True):
 
     boa = BOA() 
-    valid_subsys = boa.query('select distinct subsystem_id from subsystem')
-    if subsys not in valid_subsys.subsystem_id.tolist():
+    if subsys not in boa._subsystems():
         log.error('subsystem {:s} is not valid'.format(str(subsys)))
         return None
 
     if start_time is None:
         start_time = pd.Timestamp.now() - pd.Timedelta(days=1)
-    elif type(start_time) == str:
+    elif isinstance(start_time, str):
         start_time = pd.Timestamp(start_time)
 
     if stop_time is None:
         stop_time = pd.Timestamp.now()
-    elif type(stop_time) == str:
+    elif isinstance(stop_time, str):
         stop_time = pd.Timestamp(stop_time)
 
+    start_s = start_time.strftime(date_format)
+    stop_s = stop_time.strftime(date_format)
+
     query = "SELECT * FROM TELEMETRY_PACKET WHERE on_board_time >= '{:s}' and on_board_time <= '{:s}' and subsystem_id='{:s}'".format(
-            start_time.strftime(date_format), stop_time.strftime(date_format), subsys.upper())
+            start_s, stop_s, subsys.upper())
 
     filename = boa.retrieve_data(query, dl_path=dl_path, binary=binary, extract=extract)
 
@@ -395,8 +548,8 @@ def get_filename_from_cd(cd):
     """
     if not cd:
         return None
-    fname = re.findall('filename=(.+)', cd)
-    if len(fname) == 0:
+    fname = filename_re.search(cd)
+    if fname is None:
         return None
 
-    return fname[0].strip('\"')
\ No newline at end of file
+    return fname.group(1).strip('\"')
\ No newline at end of file